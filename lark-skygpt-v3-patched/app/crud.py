@@ -1,12 +1,18 @@
 # app/crud.py
-from typing import List, Optional, Dict, Any
+import sys
+import logging
+from typing import List, Optional, Dict, Any, AsyncIterator, Tuple
 from datetime import datetime
-from sqlalchemy import select, and_
+from sqlalchemy import select, and_, or_, func, insert, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from .database import Message, SummaryLock, Chat
 
+logger = logging.getLogger(__name__)
+
 # ============ Chat 相关 ============
-async def upsert_chat(db: AsyncSession, chat_id: str, name: Optional[str]) -> None:
+async def upsert_chat(db: AsyncSession, chat_id: str, name: Optional[str]) -> bool:
+    """登记/刷新单个群；返回是否成功提交"""
     row = (await db.execute(select(Chat).where(Chat.chat_id == chat_id))).scalar_one_or_none()
     now = datetime.utcnow()
     if row:
@@ -17,8 +23,35 @@ async def upsert_chat(db: AsyncSession, chat_id: str, name: Optional[str]) -> No
         db.add(Chat(chat_id=chat_id, name=name, last_seen=now))
     try:
         await db.commit()
+        return True
     except Exception:
         await db.rollback()
+        return False
+
+async def upsert_chats_bulk(db: AsyncSession, chat_ids: List[str]) -> bool:
+    """批量登记群并刷新 last_seen，只提交一次；返回是否成功提交（失败时调用方下次重试）"""
+    ids = set(chat_ids)
+    if not ids:
+        return True
+    now = datetime.utcnow()
+    try:
+        if db.get_bind().dialect.name == "postgresql":
+            # 一条 INSERT ... ON CONFLICT：多进程同时登记同一新群也不会撞唯一约束
+            stmt = pg_insert(Chat).values([{"chat_id": cid, "last_seen": now} for cid in ids])
+            await db.execute(
+                stmt.on_conflict_do_update(index_elements=["chat_id"], set_={"last_seen": stmt.excluded.last_seen})
+            )
+        else:
+            existing = set((await db.execute(select(Chat.chat_id).where(Chat.chat_id.in_(ids)))).scalars().all())
+            if existing:
+                await db.execute(update(Chat).where(Chat.chat_id.in_(existing)).values(last_seen=now))
+            db.add_all(Chat(chat_id=cid, last_seen=now) for cid in ids - existing)
+        await db.commit()
+        return True
+    except Exception as e:
+        await db.rollback()
+        logger.warning("upsert_chats_bulk failed chats=%s err=%s", len(ids), e)
+        return False
 
 async def set_chat_enabled(db: AsyncSession, chat_id: str, enabled: bool) -> None:
     row = (await db.execute(select(Chat).where(Chat.chat_id == chat_id))).scalar_one_or_none()
@@ -50,19 +83,53 @@ async def set_chat_schedule(
     except Exception:
         await db.rollback()
 
+def _chat_dict(r: Chat) -> Dict[str, Any]:
+    # 时区只有少数几种取值，intern 后各群共用同一字符串，后续作 dict key 比较更快
+    return {
+        "chat_id": r.chat_id,
+        "tz": sys.intern(r.tz) if r.tz else r.tz,
+        "hour": r.summary_hour,
+        "lang": r.lang,
+        "name": r.name,
+    }
+
 async def get_all_chats(db: AsyncSession) -> List[Dict[str, Any]]:
     res = await db.execute(select(Chat).where(Chat.enabled.is_(True)))
     rows = res.scalars().all()
-    out = [{"chat_id": r.chat_id, "tz": r.tz, "hour": r.summary_hour, "lang": r.lang, "name": r.name} for r in rows]
+    out = [_chat_dict(r) for r in rows]
     if out:
         return out
     # 允许回退环境变量（应急/灰度）
+    return [{"chat_id": i, "tz": "Asia/Taipei", "hour": 8, "lang": "zh", "name": None} for i in _env_chat_ids()]
+
+async def get_enabled_chat_tzs(db: AsyncSession) -> List[Tuple[str, Optional[str]]]:
+    """只取 (chat_id, tz) 两列，供批量摘要使用，不组装整行 dict"""
+    res = await db.execute(select(Chat.chat_id, Chat.tz).where(Chat.enabled.is_(True)))
+    out = [tuple(r) for r in res.all()]
+    if out:
+        return out
+    return [(i, "Asia/Taipei") for i in _env_chat_ids()]
+
+async def get_enabled_chat_timezones(db: AsyncSession) -> List[Optional[str]]:
+    """启用群里出现过的时区（去重），供按小时筛选前计算各时区当前小时"""
+    res = await db.execute(select(Chat.tz).where(Chat.enabled.is_(True)).distinct())
+    return list(res.scalars().all())
+
+async def get_chats_scheduled_at(db: AsyncSession, hour_by_tz: Dict[Optional[str], int]) -> List[Dict[str, Any]]:
+    """只取「所在时区当前小时 == 设定小时」的启用群，筛选放在 SQL 端（summary_hour 为空按 8 点）"""
+    if not hour_by_tz:
+        return []
+    conds = [
+        and_(Chat.tz.is_(None) if tz is None else Chat.tz == tz, func.coalesce(Chat.summary_hour, 8) == hour)
+        for tz, hour in hour_by_tz.items()
+    ]
+    res = await db.execute(select(Chat).where(Chat.enabled.is_(True), or_(*conds)))
+    return [_chat_dict(r) for r in res.scalars().all()]
+
+def _env_chat_ids() -> List[str]:
     import os
     ids_env = (os.getenv("SUMMARY_CHAT_IDS", "") or "").strip()
-    if ids_env:
-        return [{"chat_id": i.strip(), "tz": "Asia/Taipei", "hour": 8, "lang": "zh", "name": None}
-                for i in ids_env.split(",") if i.strip()]
-    return []
+    return [i.strip() for i in ids_env.split(",") if i.strip()]
 
 # ============ Message 相关 ============
 async def save_message(
@@ -88,8 +155,47 @@ async def save_message(
     db.add(m)
     try:
         await db.commit()
-    except Exception:
+    except Exception as e:
         await db.rollback()
+        logger.warning("save_message dropped chat=%s ts_ms=%s: %s", chat_id, ts_ms, e)
+
+async def save_messages_bulk(db: AsyncSession, rows: List[Dict[str, Any]]) -> None:
+    """批量写入消息：一次查重 + 一条多值 INSERT（与 save_message 相同的 chat_id/ts_ms/text 去重规则）"""
+    if not rows:
+        return
+    existing = await db.execute(
+        select(Message.chat_id, Message.ts_ms, Message.text).where(
+            and_(
+                Message.chat_id.in_({r["chat_id"] for r in rows}),
+                Message.ts_ms.in_({r["ts_ms"] for r in rows}),
+            )
+        )
+    )
+    seen = {tuple(r) for r in existing.all()}
+    fresh = []
+    for r in rows:
+        key = (r["chat_id"], r["ts_ms"], r["text"])
+        if key in seen:
+            continue
+        seen.add(key)
+        fresh.append(r)
+    if not fresh:
+        return
+    try:
+        await db.execute(insert(Message).values(fresh))
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        # 一条坏数据（如含 NUL 的文字）会让整批回滚：逐条重写，只丢坏的那条
+        logger.warning("save_messages_bulk failed (%s rows), retrying row by row: %s", len(fresh), e)
+        for r in fresh:
+            try:
+                await save_message(
+                    db, r["chat_id"], r["text"], r.get("sender_id"), r["ts_ms"], r.get("msg_type") or "text"
+                )
+            except Exception as row_err:
+                await db.rollback()
+                logger.warning("save_message dropped chat=%s ts_ms=%s: %s", r["chat_id"], r["ts_ms"], row_err)
 
 async def get_messages_between(
     db: AsyncSession, chat_id: str, start: datetime, end: datetime
@@ -106,6 +212,44 @@ async def get_messages_between(
     rows = res.scalars().all()
     return [{"text": r.text, "ts_ms": r.ts_ms, "sender_id": r.sender_id, "type": r.msg_type} for r in rows]
 
+async def iter_messages_between(
+    db: AsyncSession, chat_id: str, start: datetime, end: datetime
+) -> AsyncIterator[str]:
+    """以服务端游标逐批读取区间内的非空消息文字（长区间不一次性载入内存）"""
+    result = await db.stream(
+        select(Message.text).where(
+            and_(
+                Message.chat_id == chat_id,
+                Message.ts_ms >= int(start.timestamp() * 1000),
+                Message.ts_ms <  int(end.timestamp() * 1000),
+                Message.text.isnot(None),
+                Message.text != "",
+            )
+        ).order_by(Message.ts_ms.asc()).execution_options(yield_per=1000)
+    )
+    async for row in result:
+        yield row[0]
+
+async def iter_messages_by_chat_between(
+    db: AsyncSession, chat_ids: List[str], start: datetime, end: datetime
+) -> AsyncIterator[Tuple[str, str]]:
+    """一次范围扫描逐批读取多个群的 (chat_id, text)，按 chat_id、时间排序（不一次性载入内存）"""
+    if not chat_ids:
+        return
+    result = await db.stream(
+        select(Message.chat_id, Message.text).where(
+            and_(
+                Message.chat_id.in_(chat_ids),
+                Message.ts_ms >= int(start.timestamp() * 1000),
+                Message.ts_ms <  int(end.timestamp() * 1000),
+                Message.text.isnot(None),
+                Message.text != "",
+            )
+        ).order_by(Message.chat_id.asc(), Message.ts_ms.asc()).execution_options(yield_per=1000)
+    )
+    async for row in result:
+        yield row[0], row[1]
+
 # ============ 摘要锁（当日防重）===========
 async def acquire_summary_lock(db: AsyncSession, summary_date: str, chat_id: str) -> bool:
     exists = await db.execute(
@@ -121,3 +265,26 @@ async def acquire_summary_lock(db: AsyncSession, summary_date: str, chat_id: str
         await db.rollback()
         return False
 
+async def acquire_summary_locks_bulk(db: AsyncSession, summary_date: str, chat_ids: List[str]) -> set[str]:
+    """一次 INSERT ... ON CONFLICT DO NOTHING RETURNING 认领多个群的当日锁，返回本次成功认领的 chat_id"""
+    ids = list(dict.fromkeys(c for c in chat_ids if c))
+    if not ids:
+        return set()
+    if db.get_bind().dialect.name != "postgresql":
+        # 非 Postgres 退回逐个认领
+        return {c for c in ids if await acquire_summary_lock(db, summary_date, c)}
+    stmt = (
+        pg_insert(SummaryLock)
+        .values([{"summary_date": summary_date, "chat_id": c} for c in ids])
+        .on_conflict_do_nothing(index_elements=["summary_date", "chat_id"])
+        .returning(SummaryLock.chat_id)
+    )
+    try:
+        got = set((await db.execute(stmt)).scalars().all())
+        await db.commit()
+        return got
+    except Exception as e:
+        await db.rollback()
+        # 抛给调用方走降级分支；返回空集合会被误当成「今天都已摘要过」
+        logger.warning("acquire_summary_locks_bulk failed day=%s chats=%s err=%s", summary_date, len(ids), e)
+        raise
@@ -4,6 +4,7 @@ import json
 import time
 import asyncio
 import logging
+from contextlib import asynccontextmanager
 from typing import Any, Dict
 
 import httpx
@@ -18,6 +19,13 @@ from .openai_client import (
     describe_pdf_from_message_or_fallback,
 )
 
+# JSON 解碼：有 orjson 就用，否則退回標準庫
+try:
+    import orjson  # type: ignore
+    _loads = orjson.loads
+except Exception:
+    _loads = json.loads
+
 # 若有 tasks 則掛上；沒有也不影響主要流程（摘要/落庫/管理命令）
 try:
     from . import tasks  # noqa
@@ -29,7 +37,38 @@ except Exception:
 logger = logging.getLogger("web")
 logging.basicConfig(level=getattr(logging, (os.getenv("LOG_LEVEL") or "INFO").upper(), logging.INFO))
 
-app = FastAPI()
+# 排程器進程內模式：SCHEDULER_IN_WEB=1 時由 web 進程直接跑 APScheduler，可省掉獨立 worker 服務
+# （多個 gunicorn worker 各自起排程器也無妨：掃描鎖 + SummaryLock 保證同日每群只摘要一次）
+SCHEDULER_IN_WEB = (os.getenv("SCHEDULER_IN_WEB") or "0").strip().lower() in ("1", "true", "yes", "on")
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    if _HAS_TASKS and hasattr(tasks, "start_message_writer"):
+        tasks.start_message_writer()
+    scheduler = None
+    if SCHEDULER_IN_WEB:
+        try:
+            import scheduler_worker  # 延遲匯入：未啟用時不載入 APScheduler
+            scheduler = await scheduler_worker.start_scheduler()
+        except Exception as e:
+            logger.error("in-process scheduler failed to start: %s", e)
+    yield
+    if scheduler is not None:
+        try:
+            await scheduler_worker.stop_scheduler(scheduler)
+        except Exception as e:
+            logger.debug("stop_scheduler failed: %s", e)
+    # 寫完佇列中尚未落庫的訊息
+    if _HAS_TASKS and hasattr(tasks, "stop_message_writer"):
+        await tasks.stop_message_writer()
+    # 關閉 tasks 共用的 HTTP 連線池
+    if _HAS_TASKS and hasattr(tasks, "aclose_http"):
+        try:
+            await tasks.aclose_http()
+        except Exception as e:
+            logger.debug("aclose_http failed: %s", e)
+
+app = FastAPI(lifespan=lifespan)
 
 # =========================
 # Lark：租戶 Token & 發送文字
@@ -239,19 +278,19 @@ async def _process_lark_event(event: Dict[str, Any]) -> None:
     content_raw = msg.get("content", "{}")
     logger.info("process_event start: chat_id=%s, msg_type=%s, msg_id=%s", chat_id, msg_type, message_id)
 
+    # 解析內容（只解析一次，與 tasks 共用）
+    try:
+        content = _loads(content_raw) if isinstance(content_raw, str) else (content_raw or {})
+    except Exception:
+        content = {}
+
     # 非阻塞寫庫（若有 tasks）
     if _HAS_TASKS and hasattr(tasks, "record_message"):
         try:
-            asyncio.create_task(tasks.record_message(event))
+            asyncio.create_task(tasks.record_message(event, parsed_content=content))
         except Exception as _e:
             logger.debug("record_message 啟動失敗：%s", _e)
 
-    # 解析內容
-    try:
-        content = json.loads(content_raw) if isinstance(content_raw, str) else (content_raw or {})
-    except Exception:
-        content = {}
-
     if not chat_id:
         logger.info("process_event: missing chat_id, skip")
         return
@@ -270,7 +309,7 @@ async def _process_lark_event(event: Dict[str, Any]) -> None:
     if lower.startswith("#summary") and _HAS_TASKS and hasattr(tasks, "maybe_handle_summary_command"):
         try:
             logger.info("process_event: force forward summary command")
-            await tasks.maybe_handle_summary_command(event)
+            await tasks.maybe_handle_summary_command(event, parsed_content=content)
         except Exception as e:
             logger.error("force forward summary command failed: %s", e)
         return
@@ -290,7 +329,7 @@ async def _process_lark_event(event: Dict[str, Any]) -> None:
             # 常规命令处理（有 @ 的情况）
             if _HAS_TASKS and hasattr(tasks, "maybe_handle_summary_command"):
                 try:
-                    await tasks.maybe_handle_summary_command(event)
+                    await tasks.maybe_handle_summary_command(event, parsed_content=content)
                 except Exception as _e:
                     logger.debug("maybe_handle_summary_command failed: %s", _e)
 
@@ -1,5 +1,6 @@
 import os
 import json
+import asyncio
 import logging
 import base64
 from typing import Optional
@@ -12,6 +13,7 @@ logger = logging.getLogger(__name__)
 # ---- OpenAI Chat Completions 端點與模型 ----
 OPENAI_API_URL = "https://api.openai.com/v1/chat/completions"
 DEFAULT_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+SUMMARY_FALLBACK_PREFIX = "(降級摘要)"  # 降級摘要的開頭標記（呼叫方據此判斷是否為降級輸出）
 
 # ========================= 文字 Chat =========================
 async def _chat_completion(
@@ -66,7 +68,7 @@ async def summarize_text_or_fallback(http: httpx.AsyncClient, text: str) -> str:
     if not (settings.OPENAI_API_KEY and settings.OPENAI_API_KEY.strip()):
         lines = [ln.strip() for ln in (text or "").splitlines() if ln.strip()][:10]
         bullets = "\n".join(f"- {ln[:120]}" for ln in lines)
-        return f"(降級摘要)\n{bullets}" if bullets else "(降級摘要) 無可摘要內容"
+        return f"{SUMMARY_FALLBACK_PREFIX}\n{bullets}" if bullets else f"{SUMMARY_FALLBACK_PREFIX} 無可摘要內容"
     sys_prompt = (
         "你是嚴謹的中文摘要助手，輸出需：\n"
         "• 保持關鍵事實與數字\n"
@@ -79,7 +81,24 @@ async def summarize_text_or_fallback(http: httpx.AsyncClient, text: str) -> str:
         logger.exception("summarize_text_or_fallback failed: %s", e)
         lines = [ln.strip() for ln in (text or "").splitlines() if ln.strip()][:10]
         bullets = "\n".join(f"- {ln[:120]}" for ln in lines)
-        return f"(降級摘要)\n{bullets}" if bullets else "(降級摘要) 無可摘要內容"
+        return f"{SUMMARY_FALLBACK_PREFIX}\n{bullets}" if bullets else f"{SUMMARY_FALLBACK_PREFIX} 無可摘要內容"
+
+async def merge_summaries_or_fallback(http: httpx.AsyncClient, partials: list[str]) -> str:
+    """把分段摘要合併成一份；合併指令放在 system prompt，降級時直接回傳分段摘要原文。"""
+    joined = "\n".join(p.strip() for p in partials if p and p.strip())
+    if not (settings.OPENAI_API_KEY and settings.OPENAI_API_KEY.strip()):
+        return joined
+    sys_prompt = (
+        "你是嚴謹的中文摘要助手。使用者提供的是同一時段聊天記錄的多段摘要，請合併去重為一份摘要，輸出需：\n"
+        "• 保持關鍵事實與數字\n"
+        "• 使用條列式，避免冗長\n"
+        "• 若原文含任務/決策/未決，請條列標註"
+    )
+    try:
+        return await _chat_completion(http, sys_prompt, joined, temperature=0.3, max_tokens=900)
+    except Exception as e:
+        logger.exception("merge_summaries_or_fallback failed: %s", e)
+        return joined
 
 # ========================= Lark 訊息資源下載 =========================
 LARK_TENANT_TOKEN_URL = "https://open.larksuite.com/open-apis/auth/v3/tenant_access_token/internal"
@@ -170,6 +189,19 @@ async def describe_image_from_message_or_fallback(
         return f"(降級) 圖像理解暫不可用：{e}"
 
 # ========================= PDF → 圖片(首頁) → Vision =========================
+def _render_pdf_first_page_png(pdf_bytes: bytes) -> Optional[bytes]:
+    """把 PDF 首頁轉成 PNG；空文件回傳 None"""
+    import fitz  # PyMuPDF
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        if doc.page_count == 0:
+            return None
+        page = doc.load_page(0)
+        pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
+        return pix.tobytes("png")
+    finally:
+        doc.close()
+
 async def describe_pdf_from_message_or_fallback(
     http: httpx.AsyncClient, message_id: str, file_key: str
 ) -> str:
@@ -184,13 +216,10 @@ async def describe_pdf_from_message_or_fallback(
         return f"(降級) 下載 PDF 錯誤：{e}"
 
     try:
-        import fitz  # PyMuPDF
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        if doc.page_count == 0:
+        # PDF 解析與點陣化是同步 CPU 工作，丟到執行緒池，避免卡住其他 webhook
+        img_bytes = await asyncio.to_thread(_render_pdf_first_page_png, pdf_bytes)
+        if img_bytes is None:
             return "(降級) PDF 內容為空，無法解析。"
-        page = doc.load_page(0)
-        pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-        img_bytes = pix.tobytes("png")
     except Exception as e:
         logger.exception("PDF 轉圖失敗：%s", e)
         return f"(降級) PDF 轉圖失敗，請改傳圖片或檢查權限：{e}"
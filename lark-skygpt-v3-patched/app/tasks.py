@@ -4,17 +4,25 @@ Asynchronous tasks for message recording, summarisation and command handling.
 
 from __future__ import annotations
 
+import io
 import os
 import json
+import asyncio
 import logging
 import re
+import time
+import uuid
+from types import MappingProxyType
 from datetime import datetime, timedelta, time as dt_time, date
+from collections import defaultdict, deque
+from functools import lru_cache
 from typing import Dict, Any, Tuple
 
 import httpx
-from zoneinfo import ZoneInfo
+from sqlalchemy.ext.asyncio import AsyncSession
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
-from .openai_client import summarize_text_or_fallback
+from .openai_client import summarize_text_or_fallback, merge_summaries_or_fallback, SUMMARY_FALLBACK_PREFIX
 from .database import AsyncSessionFactory
 from . import crud
 
@@ -24,6 +32,20 @@ try:
 except Exception:
     reply_text = None  # type: ignore
 
+# 兜底发送函数只在载入时解析一次
+try:
+    from . import lark_client
+    _fallback_send = getattr(lark_client, "send_text_to_chat", None)
+except Exception:
+    _fallback_send = None
+
+# JSON 解码：有 orjson 就用（更快），否则退回标准库
+try:
+    import orjson  # type: ignore
+    _loads = orjson.loads
+except Exception:
+    _loads = json.loads
+
 # Redis（用于管理员临时登录，会话可绑定“用户 open_id”或“当前群”）
 try:
     import redis.asyncio as aioredis  # type: ignore
@@ -35,67 +57,207 @@ REDIS_URL = os.getenv("REDIS_URL") or os.getenv("REDIS_CONNECTION_URL") or ""
 ADMIN_CODE = os.getenv("SUMMARY_ADMIN_CODE", "")
 ADMIN_TTL_SEC = int(os.getenv("SUMMARY_ADMIN_TTL_SEC", "21600"))  # 默认 6 小时
 MAX_RANGE_DAYS = int(os.getenv("SUMMARY_MAX_RANGE_DAYS", "31"))
-
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "8"))  # 多群摘要并发上限
+SUMMARY_LLM_CONCURRENCY = int(os.getenv("SUMMARY_LLM_CONCURRENCY", "4"))  # 同时调用模型的上限
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "60000"))  # 送模型的文字上限（超出保留最近部分）
+SUMMARY_CHUNK_CHARS = int(os.getenv("SUMMARY_CHUNK_CHARS", "12000"))  # 超过则分段摘要再合并
+MSG_QUEUE_MAX = int(os.getenv("MSG_QUEUE_MAX", "10000"))
+MSG_BATCH_SIZE = int(os.getenv("MSG_BATCH_SIZE", "500"))
+MSG_FLUSH_MS = int(os.getenv("MSG_FLUSH_MS", "200"))
+
+# 日志配置由入口（main.py / scheduler_worker.py）负责，这里不调用 basicConfig
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=getattr(logging, (os.getenv("LOG_LEVEL") or "INFO").upper(), logging.INFO))
 
-DEFAULT_TZ = ZoneInfo("Asia/Taipei")
-_redis = aioredis.from_url(REDIS_URL) if (aioredis and REDIS_URL) else None
+if ADMIN_TTL_SEC <= 0:
+    # 管理员会话必须带 TTL，否则 key 永不过期
+    logger.warning("SUMMARY_ADMIN_TTL_SEC=%s 无效，改用默认 21600 秒", ADMIN_TTL_SEC)
+    ADMIN_TTL_SEC = 21600
+
+DEFAULT_TZ_NAME = "Asia/Taipei"
+DEFAULT_TZ = ZoneInfo(DEFAULT_TZ_NAME)
+_EMPTY = MappingProxyType({})  # 只读空映射，作为 .get() 缺省值，免得每次新建空 dict
+_redis = (
+    aioredis.from_url(REDIS_URL, max_connections=16, decode_responses=True)
+    if (aioredis and REDIS_URL) else None
+)
+_ADMIN_CACHE: dict[str, float] = {}  # 会话 key → 本地缓存到期时间（monotonic）
+# 本地命中缓存秒数：只有本进程 logout 会立即清掉；其他进程 logout 后，本进程最多还会放行这么久
+_ADMIN_CACHE_TTL = 30
+_ADMIN_CACHE_MAX = 1024  # 条数达到上限时，写入前先清掉已过期的 key，避免字典随群/用户数无限增长
+
+# 指令正则（模块载入时预编译）
+_RE_AT = re.compile(r"#summary\s+at\s+(\d{1,2})(?::\d{2})?")
+_RE_TZ = re.compile(r"#summary\s+tz\s+([\w/\\-]+)")
+_RE_LANG = re.compile(r"#summary\s+lang\s+(zh|en)")
+
+# 按事件循环缓存的 asyncio 原语：换了事件循环（如测试复用模块）就重建，避免 "bound to a different event loop"
+_LOOP_BOUND: dict[str, tuple[asyncio.AbstractEventLoop, Any]] = {}
+
+
+def loop_bound(name: str, factory):
+    """按名称取当前事件循环下的对象，不存在或属于旧循环时用 factory() 重建（worker 也共用）"""
+    loop = asyncio.get_running_loop()
+    cur = _LOOP_BOUND.get(name)
+    if cur is None or cur[0] is not loop:
+        cur = _LOOP_BOUND[name] = (loop, factory())
+    return cur[1]
+
+
+def _llm_sem() -> asyncio.Semaphore:
+    """LLM 调用并发上限，与群级并发分开调，避免打爆模型限流"""
+    return loop_bound("llm_sem", lambda: asyncio.Semaphore(SUMMARY_LLM_CONCURRENCY))
+
+
+# 共用 HTTP 连接池：指令回覆复用 keep-alive 连接，避免每次回覆都重新握手（首次使用时才建立）
+_HTTP: httpx.AsyncClient | None = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global _HTTP
+    if _HTTP is None or _HTTP.is_closed:
+        _HTTP = httpx.AsyncClient(
+            timeout=10.0,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30),
+        )
+    return _HTTP
+
+
+async def aclose_redis() -> None:
+    """断开 Redis 连接池（连接绑定在当前事件循环上；之后再用会在新的循环里重连）"""
+    if _redis is not None:
+        await _redis.connection_pool.disconnect()
+
+
+async def aclose_http() -> None:
+    """关闭共用 HTTP 客户端（由应用关闭钩子调用）"""
+    global _HTTP
+    if _HTTP is not None:
+        await _HTTP.aclose()
+        _HTTP = None
 
 
 # ========== 统一回覆 ==========
 async def _send_reply(http: httpx.AsyncClient, chat_id: str, text: str) -> None:
     """reply_text → lark_client.send_text_to_chat（兜底）"""
-    try:
-        if reply_text:
+    if reply_text:
+        try:
             await reply_text(http, chat_id, text)  # type: ignore
             return
-    except Exception:
-        pass
+        except Exception:
+            pass
+    if _fallback_send:
+        try:
+            await _fallback_send(http, chat_id, text)
+        except Exception:
+            pass
+
+
+# ========== 跨副本排他锁（扫描级） ==========
+# 只删除自己持有的锁，避免锁过期后误删其他副本新取得的锁
+_UNLOCK_LUA = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+
+
+async def try_acquire_lock(name: str, ttl_sec: int = 60) -> str | None:
+    """SET NX EX 取锁：成功回传 token，被其他副本持有回传 None；无 Redis 或 Redis 出错时回传空字符串（放行）"""
+    if not _redis:
+        return ""
+    token = uuid.uuid4().hex
     try:
-        from . import lark_client
-        if hasattr(lark_client, "send_text_to_chat"):
-            await lark_client.send_text_to_chat(http, chat_id, text)
-            return
-    except Exception:
-        pass
+        ok = await _redis.set(f"lock:{name}", token, nx=True, ex=ttl_sec)
+    except Exception as e:
+        logger.warning("lock %s acquire failed, proceeding without it: %s", name, e)
+        return ""
+    return token if ok else None
+
+
+async def release_lock(name: str, token: str | None) -> None:
+    if not _redis or not token:
+        return
+    try:
+        await _redis.eval(_UNLOCK_LUA, 1, f"lock:{name}", token)
+    except Exception as e:
+        logger.debug("lock %s release failed: %s", name, e)
 
 
 # ========== 管理员会话（用户/群） ==========
+async def _touch(key: str) -> None:
+    """写入管理员会话 key（统一带 ADMIN_TTL_SEC 过期）"""
+    await _redis.set(key, "1", ex=ADMIN_TTL_SEC)
+
 async def _set_admin(open_id: str) -> None:
     if not _redis or not open_id:
         return
-    await _redis.set(f"summary:admin:{open_id}", "1", ex=ADMIN_TTL_SEC)
+    await _touch(f"summary:admin:{open_id}")
 
 async def _del_admin(open_id: str) -> None:
     if not _redis or not open_id:
         return
-    await _redis.delete(f"summary:admin:{open_id}")
+    key = f"summary:admin:{open_id}"
+    _ADMIN_CACHE.pop(key, None)
+    await _redis.delete(key)
 
 async def _set_admin_chat(chat_id: str) -> None:
     if not _redis or not chat_id:
         return
-    await _redis.set(f"summary:admin_chat:{chat_id}", "1", ex=ADMIN_TTL_SEC)
+    await _touch(f"summary:admin_chat:{chat_id}")
 
 async def _del_admin_chat(chat_id: str) -> None:
     if not _redis or not chat_id:
         return
-    await _redis.delete(f"summary:admin_chat:{chat_id}")
+    key = f"summary:admin_chat:{chat_id}"
+    _ADMIN_CACHE.pop(key, None)
+    await _redis.delete(key)
 
 async def _is_admin_both(open_id: str, chat_id: str) -> bool:
     """既检查用户会话，也检查本群会话"""
     if not _redis:
         return False
-    if open_id and await _redis.get(f"summary:admin:{open_id}"):
-        return True
-    if chat_id and await _redis.get(f"summary:admin_chat:{chat_id}"):
+    keys = []
+    if open_id:
+        keys.append(f"summary:admin:{open_id}")
+    if chat_id:
+        keys.append(f"summary:admin_chat:{chat_id}")
+    if not keys:
+        return False
+    # 短时间内重复指令直接命中本地缓存，不走 Redis
+    now = time.monotonic()
+    if any(_ADMIN_CACHE.get(k, 0) > now for k in keys):
         return True
-    return False
+    # 一次往返：MGET 取会话 + EXPIRE 续期（滑动 TTL；不存在的 key 不受影响）
+    async with _redis.pipeline(transaction=False) as pipe:
+        pipe.mget(keys)
+        for k in keys:
+            pipe.expire(k, ADMIN_TTL_SEC)
+        res = await pipe.execute()
+    if len(_ADMIN_CACHE) >= _ADMIN_CACHE_MAX:
+        for k in [k for k, exp in _ADMIN_CACHE.items() if exp <= now]:
+            del _ADMIN_CACHE[k]
+    hit = False
+    for k, v in zip(keys, res[0]):
+        if v:
+            _ADMIN_CACHE[k] = now + _ADMIN_CACHE_TTL
+            hit = True
+        else:
+            _ADMIN_CACHE.pop(k, None)  # Redis 已无此会话，顺手清掉本地的过期项
+    return hit
 
 
 # ========== 时间工具 ==========
-def _yesterday_range(tz: str | ZoneInfo = DEFAULT_TZ) -> Tuple[datetime, datetime]:
-    tz_obj = ZoneInfo(str(tz)) if isinstance(tz, str) else tz
+@lru_cache(maxsize=64)
+def zone_info(name: str) -> ZoneInfo:
+    """按名称缓存 ZoneInfo，避免每个群都重新解析 tzdata"""
+    return ZoneInfo(name)
+
+def _safe_zone(name: str | None) -> ZoneInfo:
+    """群设定的时区；名称无效（如被小写成 asia/tokyo）时记警告并退回默认时区，不让单个群拖垮整批摘要"""
+    try:
+        return zone_info(name or DEFAULT_TZ_NAME)
+    except (ZoneInfoNotFoundError, ValueError) as e:
+        logger.warning("invalid chat tz %r, falling back to %s: %s", name, DEFAULT_TZ_NAME, e)
+        return DEFAULT_TZ
+
+def yesterday_range(tz: str | ZoneInfo = DEFAULT_TZ) -> Tuple[datetime, datetime]:
+    tz_obj = zone_info(tz) if isinstance(tz, str) else tz
     now = datetime.now(tz_obj)
     today = now.date()
     y = today - timedelta(days=1)
@@ -103,50 +265,166 @@ def _yesterday_range(tz: str | ZoneInfo = DEFAULT_TZ) -> Tuple[datetime, datetim
     end = datetime.combine(today, dt_time.min, tzinfo=tz_obj)
     return start, end
 
+def _is_ymd(s: str) -> bool:
+    return len(s) == 10 and s[4] == "-" and s[7] == "-" and (s[:4] + s[5:7] + s[8:]).isdigit()
+
 def _parse_range(text: str) -> Tuple[date, date] | None:
-    """解析 'range YYYY-MM-DD to YYYY-MM-DD' 或 'range YYYY-MM-DD - YYYY-MM-DD'"""
-    m = re.search(r"range\s+(\d{4}-\d{2}-\d{2})\s*(?:to|-)\s*(\d{4}-\d{2}-\d{2})", text)
-    if not m:
+    """解析 'range YYYY-MM-DD to YYYY-MM-DD' 或 'range YYYY-MM-DD - YYYY-MM-DD'（逐段切片，不走正则）"""
+    idx = text.find("range")
+    if idx < 0:
+        return None
+    rest = text[idx + 5:]
+    if not rest[:1].isspace():
+        return None
+    rest = rest.lstrip()
+    s1, rest = rest[:10], rest[10:].lstrip()
+    if rest.startswith("to"):
+        rest = rest[2:]
+    elif rest.startswith("-"):
+        rest = rest[1:]
+    else:
+        return None
+    s2 = rest.lstrip()[:10]
+    if not (_is_ymd(s1) and _is_ymd(s2)):
         return None
     try:
-        d1 = datetime.strptime(m.group(1), "%Y-%m-%d").date()
-        d2 = datetime.strptime(m.group(2), "%Y-%m-%d").date()
-    except Exception:
+        d1 = date.fromisoformat(s1)
+        d2 = date.fromisoformat(s2)
+    except ValueError:  # 形状已校验，这里只拦截 2024-13-40 这类非法日期
         return None
     if d2 < d1:
         return None
     return d1, d2
 
 def _start_end_from_dates(d1: date, d2: date, tz: str | ZoneInfo = DEFAULT_TZ) -> Tuple[datetime, datetime]:
-    tz_obj = ZoneInfo(str(tz)) if isinstance(tz, str) else tz
+    tz_obj = zone_info(tz) if isinstance(tz, str) else tz
     start = datetime.combine(d1, dt_time.min, tzinfo=tz_obj)
     end = datetime.combine(d2 + timedelta(days=1), dt_time.min, tzinfo=tz_obj)  # [start, end)
     return start, end
 
 
+# ========== 落库：批量写入队列 ==========
+_msg_queue: asyncio.Queue | None = None
+_msg_queue_loop: asyncio.AbstractEventLoop | None = None
+_flush_task: asyncio.Task | None = None
+_seen_chats: set[str] = set()  # 本进程已登记过的群，跳过重复 upsert_chat
+
+
+async def _ensure_chat(db, chat_id: str) -> None:
+    """每个 chat_id 在本进程内只 upsert 一次"""
+    if chat_id in _seen_chats:
+        return
+    if await crud.upsert_chat(db, chat_id, None):
+        _seen_chats.add(chat_id)  # 提交失败则不标记，下次指令再登记
+
+
+async def _flush_messages(batch: list[Dict[str, Any]]) -> None:
+    try:
+        async with AsyncSessionFactory() as db:
+            # 本批次中首次出现的群一次性登记
+            new_ids = {r["chat_id"] for r in batch} - _seen_chats
+            if new_ids and await crud.upsert_chats_bulk(db, list(new_ids)):
+                _seen_chats.update(new_ids)  # 只在成功提交后标记，失败的下一批再登记
+            await crud.save_messages_bulk(db, batch)
+    except Exception as e:
+        logger.warning("flush messages failed (%s rows): %s", len(batch), e)
+
+
+def _queue() -> asyncio.Queue:
+    """当前事件循环的写库队列；换了事件循环时新建，并把旧队列里未落库的消息搬过来"""
+    global _msg_queue, _msg_queue_loop
+    loop = asyncio.get_running_loop()
+    if _msg_queue is None or _msg_queue_loop is not loop:
+        old, _msg_queue, _msg_queue_loop = _msg_queue, asyncio.Queue(maxsize=MSG_QUEUE_MAX), loop
+        while old is not None and not old.empty():
+            row = old.get_nowait()
+            if row is not None:
+                _msg_queue.put_nowait(row)
+    return _msg_queue
+
+
+async def _flusher() -> None:
+    """攒满 MSG_BATCH_SIZE 条或等满 MSG_FLUSH_MS 毫秒就落库一次；收到 None 时写完剩余并退出"""
+    loop = asyncio.get_running_loop()
+    queue = _queue()
+    while True:
+        row = await queue.get()
+        if row is None:
+            return
+        batch = [row]
+        stop = False
+        deadline = loop.time() + MSG_FLUSH_MS / 1000
+        while len(batch) < MSG_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if row is None:
+                stop = True
+                break
+            batch.append(row)
+        await _flush_messages(batch)
+        if stop:
+            return
+
+
+def start_message_writer() -> None:
+    """启动后台批量写库任务（可重复调用）"""
+    global _flush_task
+    if _flush_task is None or _flush_task.done() or _flush_task.get_loop() is not asyncio.get_running_loop():
+        _flush_task = asyncio.create_task(_flusher())
+
+
+async def stop_message_writer(timeout: float = 10.0) -> None:
+    """通知写库任务写完队列中剩余消息后退出"""
+    global _flush_task
+    if _flush_task is None or _flush_task.done() or _flush_task.get_loop() is not asyncio.get_running_loop():
+        return
+    await _queue().put(None)
+    try:
+        await asyncio.wait_for(_flush_task, timeout)
+    except Exception as e:
+        logger.warning("stop message writer: %s", e)
+    _flush_task = None
+
+
+# ========== 消息内容解析 ==========
+def _parse_content(msg: Any, parsed_content: Any = None) -> Any:
+    """调用方已解析过 content 时直接复用，否则在这里解析一次"""
+    if parsed_content is not None:
+        return parsed_content
+    raw = msg.get("content") or "{}"
+    try:
+        return _loads(raw) if isinstance(raw, str) else raw or {}
+    except Exception:
+        return {}
+
+
 # ========== 落库：仅保存文字 ==========
-async def record_message(event: Dict[str, Any]) -> None:
-    """只把文字消息写入 DB，不触发指令，避免重复回复。"""
+async def record_message(event: Dict[str, Any], parsed_content: Any = None) -> None:
+    """只把文字消息放入写库队列，不触发指令，避免重复回复。"""
     try:
-        ev = event.get("event", {}) or {}
-        msg = ev.get("message", {}) or {}
+        ev = event.get("event") or _EMPTY
+        msg = ev.get("message") or _EMPTY
         if not msg:
             return
         chat_id = msg.get("chat_id")
         if not chat_id:
             return
 
+        # 非文字消息不落库，也就不必解析 content
         msg_type = (msg.get("message_type") or "").lower()
-        raw = msg.get("content") or "{}"
-        try:
-            content = json.loads(raw) if isinstance(raw, str) else raw or {}
-        except Exception:
-            content = {}
+        if msg_type != "text":
+            return
+        content = _parse_content(msg, parsed_content)
         text = (content.get("text") or "").strip() if isinstance(content, dict) else ""
 
         # sender_id（可选）
         sender_id = ""
-        s = msg.get("sender") or {}
+        s = msg.get("sender") or _EMPTY
         if isinstance(s, dict):
             sid = s.get("id")
             if isinstance(sid, dict):
@@ -158,193 +436,283 @@ async def record_message(event: Dict[str, Any]) -> None:
         try:
             ts_ms = int(msg.get("create_time") or 0)
         except Exception:
-            ts_ms = int(datetime.utcnow().timestamp() * 1000)
+            ts_ms = int(time.time() * 1000)
 
         if msg_type == "text" and text:
-            async with AsyncSessionFactory() as db:
-                await crud.upsert_chat(db, chat_id, None)
-                await crud.save_message(db, chat_id=chat_id, text=text, sender_id=sender_id, ts_ms=ts_ms, msg_type="text")
+            row = {"chat_id": chat_id, "text": text, "sender_id": sender_id, "ts_ms": ts_ms, "msg_type": "text"}
+            start_message_writer()
+            try:
+                _queue().put_nowait(row)
+            except asyncio.QueueFull:
+                # 队列满时退回单条直写，宁慢勿丢
+                logger.warning("message queue full, writing directly chat_id=%s", chat_id)
+                async with AsyncSessionFactory() as db:
+                    await _ensure_chat(db, chat_id)
+                    await crud.save_message(db, **row)
     except Exception as e:
-        logger.debug(f"record_message error: {e}")
+        logger.debug("record_message error: %s", e)
 
 
 # ========== 指令处理 ==========
-async def maybe_handle_summary_command(event: Dict[str, Any]) -> None:
+# 各指令处理函数签名一致：(http, db, chat_id, text, low, sender_open_id)；登录/登出不开 DB 会话，db 为 None
+async def _cmd_login(http, db, chat_id, text, low, sender_open_id) -> None:
+    parts = text.split(None, 2)
+    code = parts[2].strip() if len(parts) >= 3 else ""
+    if not ADMIN_CODE:
+        await _send_reply(http, chat_id, "系统未设置 SUMMARY_ADMIN_CODE，无法登录。")
+        return
+    if code != ADMIN_CODE:
+        await _send_reply(http, chat_id, "口令错误。")
+        return
+    if sender_open_id:
+        await _set_admin(sender_open_id)
+        await _send_reply(http, chat_id, "管理员登录成功（按用户，6小时）。")
+    else:
+        await _set_admin_chat(chat_id)
+        await _send_reply(http, chat_id, "管理员登录成功（按本群，6小时）。")
+
+async def _cmd_logout(http, db, chat_id, text, low, sender_open_id) -> None:
+    if sender_open_id:
+        await _del_admin(sender_open_id)
+    await _del_admin_chat(chat_id)
+    await _send_reply(http, chat_id, "已登出管理员。")
+
+async def _cmd_range(http, db, chat_id, text, low, sender_open_id) -> None:
+    """本群区间摘要"""
+    rng = _parse_range(low)
+    if not rng:
+        await _send_reply(http, chat_id, "用法：#summary range YYYY-MM-DD to YYYY-MM-DD")
+        return
+    d1, d2 = rng
+    if (d2 - d1).days + 1 > MAX_RANGE_DAYS:
+        await _send_reply(http, chat_id, f"区间过大，最多 {MAX_RANGE_DAYS} 天。")
+        return
+    start, end = _start_end_from_dates(d1, d2)
+    await _summarize_for_chat_in_range(http, chat_id, start, end, db=db)
+
+async def _cmd_all_range(http, db, chat_id, text, low, sender_open_id) -> None:
+    """所有启用群区间摘要（需登录）"""
+    if not await _is_admin_both(sender_open_id, chat_id):
+        await _send_reply(http, chat_id, "没有权限执行此指令，请先 #summary login <code>。")
+        return
+    rng = _parse_range(low)
+    if not rng:
+        await _send_reply(http, chat_id, "用法：#summary all range YYYY-MM-DD to YYYY-MM-DD")
+        return
+    d1, d2 = rng
+    if (d2 - d1).days + 1 > MAX_RANGE_DAYS:
+        await _send_reply(http, chat_id, f"区间过大，最多 {MAX_RANGE_DAYS} 天。")
+        return
+    start, end = _start_end_from_dates(d1, d2)
+    n = await _summarize_for_all_chats_in_range(http, start, end, db=db)
+    await _send_reply(http, chat_id, f"已对 {n} 个群发送区间摘要。")
+
+async def _cmd_once(http, db, chat_id, text, low, sender_open_id) -> None:
+    """立即整理（昨日）"""
+    await summarize_for_single_chat(http, chat_id, db=db)
+
+async def _cmd_off(http, db, chat_id, text, low, sender_open_id) -> None:
+    await crud.set_chat_enabled(db, chat_id, False)
+    _invalidate_chats_cache()
+    await _send_reply(http, chat_id, "已关闭本群每日摘要。")
+
+async def _cmd_on(http, db, chat_id, text, low, sender_open_id) -> None:
+    await crud.set_chat_enabled(db, chat_id, True)
+    _invalidate_chats_cache()
+    await _send_reply(http, chat_id, "已开启本群每日摘要。")
+
+async def _cmd_at(http, db, chat_id, text, low, sender_open_id) -> None:
+    m = _RE_AT.search(low)
+    if m:
+        hour = max(0, min(23, int(m.group(1))))
+        await crud.set_chat_schedule(db, chat_id, hour=hour)
+        await _send_reply(http, chat_id, f"已更新本群每日摘要时间为 {hour:02d}:00。")
+
+async def _cmd_tz(http, db, chat_id, text, low, sender_open_id) -> None:
+    m = _RE_TZ.search(low)
+    if m:
+        tz = m.group(1)
+        await crud.set_chat_schedule(db, chat_id, tz=tz)
+        _invalidate_chats_cache()
+        await _send_reply(http, chat_id, f"已更新本群摘要时区为 {tz}。")
+
+async def _cmd_lang(http, db, chat_id, text, low, sender_open_id) -> None:
+    m = _RE_LANG.search(low)
+    if m:
+        lang = m.group(1)
+        await crud.set_chat_schedule(db, chat_id, lang=lang)
+        await _send_reply(http, chat_id, f"已更新本群摘要语言为 {lang}。")
+
+# 指令表：按前 3 / 前 2 个词查表分派
+_HANDLERS: Dict[Tuple[str, ...], Any] = {
+    ("#summary", "login"): _cmd_login,
+    ("#summary", "logout"): _cmd_logout,
+    ("#summary", "range"): _cmd_range,
+    ("#summary", "all", "range"): _cmd_all_range,
+    ("#summary", "once"): _cmd_once,
+    ("#summary", "off"): _cmd_off,
+    ("#summary", "on"): _cmd_on,
+    ("#summary", "at"): _cmd_at,
+    ("#summary", "tz"): _cmd_tz,
+    ("#summary", "lang"): _cmd_lang,
+}
+_SESSIONLESS = frozenset({_cmd_login, _cmd_logout})
+# 查表前去掉关键字尾随的标点，让 "#summary on。"、"#summary off!" 这类写法照旧生效
+_CMD_TRAILING_PUNCT = ".,!?;:~…。，、！？；：～"
+
+
+async def maybe_handle_summary_command(event: Dict[str, Any], parsed_content: Any = None) -> None:
     try:
-        ev = event.get("event", {}) or {}
-        msg = ev.get("message", {}) or {}
+        ev = event.get("event") or _EMPTY
+        msg = ev.get("message") or _EMPTY
         chat_id = msg.get("chat_id")
-        raw = msg.get("content", "{}")
-        try:
-            content = json.loads(raw) if isinstance(raw, str) else raw or {}
-        except Exception:
-            content = {}
+        # 绝大多数消息不是指令：原始 JSON 里没有 #summary 就不必解析
+        raw = msg.get("content")
+        if parsed_content is None and isinstance(raw, str) and "#summary" not in raw.lower():
+            return
+        content = _parse_content(msg, parsed_content)
         text = (content.get("text") or "").strip()
         low = text.lower()
         if not chat_id or not low.startswith("#summary"):
             return
 
+        parts = [p.rstrip(_CMD_TRAILING_PUNCT) for p in low.split(None, 3)[:3]]
+        handler = _HANDLERS.get(tuple(parts)) or _HANDLERS.get(tuple(parts[:2]))
+        if handler is None:
+            return
+
+        # 整个指令只用一个客户端，校验失败提示与正式回覆共用同一连接
+        http = get_http_client()
+
         # 取得 open_id（优先 event.sender.sender_id.open_id，再回退 message.sender）
         sender_open_id = ""
-        sender_ev = ev.get("sender") or {}
+        sender_ev = ev.get("sender") or _EMPTY
         sid_ev = sender_ev.get("sender_id") if isinstance(sender_ev, dict) else None
         if isinstance(sid_ev, dict):
             sender_open_id = sid_ev.get("open_id") or sid_ev.get("user_id") or sid_ev.get("union_id") or ""
         else:
             sender_open_id = sender_ev.get("open_id") if isinstance(sender_ev, dict) else ""
         if not sender_open_id:
-            sender_msg = msg.get("sender") or {}
+            sender_msg = msg.get("sender") or _EMPTY
             sid_msg = sender_msg.get("sender_id") or sender_msg.get("id")
             if isinstance(sid_msg, dict):
                 sender_open_id = sid_msg.get("open_id") or sender_open_id
 
-        # 登录 / 登出
-        if low.startswith("#summary login"):
-            code = text.split(None, 2)[-1].strip() if len(text.split()) >= 3 else ""
-            async with httpx.AsyncClient() as http:
-                if not ADMIN_CODE:
-                    await _send_reply(http, chat_id, "系统未设置 SUMMARY_ADMIN_CODE，无法登录。")
-                    return
-                if code != ADMIN_CODE:
-                    await _send_reply(http, chat_id, "口令错误。")
-                    return
-                if sender_open_id:
-                    await _set_admin(sender_open_id)
-                    await _send_reply(http, chat_id, "管理员登录成功（按用户，6小时）。")
-                else:
-                    await _set_admin_chat(chat_id)
-                    await _send_reply(http, chat_id, "管理员登录成功（按本群，6小时）。")
-            return
-
-        if low.startswith("#summary logout"):
-            if sender_open_id:
-                await _del_admin(sender_open_id)
-            await _del_admin_chat(chat_id)
-            async with httpx.AsyncClient() as http:
-                await _send_reply(http, chat_id, "已登出管理员。")
+        if handler in _SESSIONLESS:
+            await handler(http, None, chat_id, text, low, sender_open_id)
             return
 
         async with AsyncSessionFactory() as db:
-            await crud.upsert_chat(db, chat_id, None)
-
-            # 本群区间摘要
-            if low.startswith("#summary range"):
-                rng = _parse_range(low)
-                if not rng:
-                    async with httpx.AsyncClient() as http:
-                        await _send_reply(http, chat_id, "用法：#summary range YYYY-MM-DD to YYYY-MM-DD")
-                    return
-                d1, d2 = rng
-                if (d2 - d1).days + 1 > MAX_RANGE_DAYS:
-                    async with httpx.AsyncClient() as http:
-                        await _send_reply(http, chat_id, f"区间过大，最多 {MAX_RANGE_DAYS} 天。")
-                    return
-                start, end = _start_end_from_dates(d1, d2)
-                async with httpx.AsyncClient() as http:
-                    await _summarize_for_chat_in_range(http, chat_id, start, end)
-                return
-
-            # 所有启用群区间摘要（需登录）
-            if low.startswith("#summary all range"):
-                async with httpx.AsyncClient() as http:
-                    if not await _is_admin_both(sender_open_id, chat_id):
-                        await _send_reply(http, chat_id, "没有权限执行此指令，请先 #summary login <code>。")
-                        return
-                rng = _parse_range(low)
-                if not rng:
-                    async with httpx.AsyncClient() as http:
-                        await _send_reply(http, chat_id, "用法：#summary all range YYYY-MM-DD to YYYY-MM-DD")
-                    return
-                d1, d2 = rng
-                if (d2 - d1).days + 1 > MAX_RANGE_DAYS:
-                    async with httpx.AsyncClient() as http:
-                        await _send_reply(http, chat_id, f"区间过大，最多 {MAX_RANGE_DAYS} 天。")
-                    return
-                start, end = _start_end_from_dates(d1, d2)
-                async with httpx.AsyncClient() as http:
-                    n = await _summarize_for_all_chats_in_range(http, start, end)
-                    await _send_reply(http, chat_id, f"已对 {n} 个群发送区间摘要。")
-                return
-
-            # 立即整理（昨日）
-            if low.startswith("#summary once"):
-                async with httpx.AsyncClient() as http:
-                    await summarize_for_single_chat(http, chat_id)
-                return
-
-            # 开启 / 关闭
-            if low.startswith("#summary off"):
-                await crud.set_chat_enabled(db, chat_id, False)
-                async with httpx.AsyncClient() as http:
-                    await _send_reply(http, chat_id, "已关闭本群每日摘要。")
-                return
-
-            if low.startswith("#summary on"):
-                await crud.set_chat_enabled(db, chat_id, True)
-                async with httpx.AsyncClient() as http:
-                    await _send_reply(http, chat_id, "已开启本群每日摘要。")
-                return
-
-            # 修改时间 / 时区 / 语言
-            m = re.search(r"#summary\s+at\s+(\d{1,2})(?::\d{2})?", low)
-            if m:
-                hour = max(0, min(23, int(m.group(1))))
-                await crud.set_chat_schedule(db, chat_id, hour=hour)
-                async with httpx.AsyncClient() as http:
-                    await _send_reply(http, chat_id, f"已更新本群每日摘要时间为 {hour:02d}:00。")
-                return
-
-            m = re.search(r"#summary\s+tz\s+([\w/\\-]+)", low)
-            if m:
-                tz = m.group(1)
-                await crud.set_chat_schedule(db, chat_id, tz=tz)
-                async with httpx.AsyncClient() as http:
-                    await _send_reply(http, chat_id, f"已更新本群摘要时区为 {tz}。")
-                return
-
-            m = re.search(r"#summary\s+lang\s+(zh|en)", low)
-            if m:
-                lang = m.group(1)
-                await crud.set_chat_schedule(db, chat_id, lang=lang)
-                async with httpx.AsyncClient() as http:
-                    await _send_reply(http, chat_id, f"已更新本群摘要语言为 {lang}。")
-                return
+            await _ensure_chat(db, chat_id)
+            await handler(http, db, chat_id, text, low, sender_open_id)
 
     except Exception as e:
-        logger.debug(f"maybe_handle_summary_command error: {e}")
+        logger.debug("maybe_handle_summary_command error: %s", e)
 
 
 # ========== 摘要产出 ==========
 async def summarize_for_single_chat(
-    http: httpx.AsyncClient, chat_id: str, tz: str | ZoneInfo = DEFAULT_TZ
+    http: httpx.AsyncClient,
+    chat_id: str,
+    tz: str | ZoneInfo = DEFAULT_TZ,
+    db: AsyncSession | None = None,
+    start: datetime | None = None,
+    end: datetime | None = None,
 ) -> None:
-    start, end = _yesterday_range(tz)
-    await _summarize_for_chat_in_range(http, chat_id, start, end)
+    """昨日摘要；批量调用方可传入按时区预先算好的 start/end，避免逐群重算"""
+    if start is None or end is None:
+        start, end = yesterday_range(tz)
+    await _summarize_for_chat_in_range(http, chat_id, start, end, db=db)
+
+async def _read_chat_text(db: AsyncSession, chat_id: str, start: datetime, end: datetime) -> str:
+    # 逐批读取文字直接写入缓冲区，不另建中间 list（空文字已在 SQL 端过滤）
+    buf = io.StringIO()
+    async for t in crud.iter_messages_between(db, chat_id, start, end):
+        if buf.tell():
+            buf.write("\n")
+        buf.write(t)
+    return buf.getvalue()
 
 async def _summarize_for_chat_in_range(
-    http: httpx.AsyncClient, chat_id: str, start: datetime, end: datetime, tz: str | ZoneInfo = DEFAULT_TZ
+    http: httpx.AsyncClient,
+    chat_id: str,
+    start: datetime,
+    end: datetime,
+    tz: str | ZoneInfo = DEFAULT_TZ,
+    db: AsyncSession | None = None,
 ) -> None:
-    async with AsyncSessionFactory() as db:
-        msgs = await crud.get_messages_between(db, chat_id, start, end)
-
+    """调用方已持有会话时直接沿用，否则自行开一个只用于读取"""
+    if db is None:
+        async with AsyncSessionFactory() as db:
+            full_text = await _read_chat_text(db, chat_id, start, end)
+    else:
+        full_text = await _read_chat_text(db, chat_id, start, end)
+        # 结束只读事务，把连接还给连接池，摘要（LLM）期间不占着 idle-in-transaction 连接
+        await db.rollback()
+    await _summarize_text_for_chat(http, chat_id, start, end, full_text)
+
+def _tail_lines(text: str, limit: int) -> str:
+    """保留最后不超过 limit 个字的内容，起点对齐到下一行开头，不从消息中间截断"""
+    if len(text) <= limit:
+        return text
+    cut = len(text) - limit
+    nl = text.find("\n", cut - 1)  # 切点正好在行首时（前一字符是换行）整行保留
+    return text[nl + 1:] if nl != -1 else text[cut:]
+
+def _chunk_text(text: str, size: int) -> list[str]:
+    """按行切成不超过 size 的段（单行过长时硬切）"""
+    chunks: list[str] = []
+    start, n = 0, len(text)
+    while start < n:
+        stop = start + size
+        if stop < n:
+            cut = text.rfind("\n", start, stop)
+            if cut > start:
+                stop = cut
+        chunks.append(text[start:stop])
+        start = stop + 1 if stop < n and text[stop] == "\n" else stop
+    return chunks
+
+async def _summarize_chunked(http: httpx.AsyncClient, text: str) -> str:
+    """短文一次调用；长文先分段并发摘要（map），再合并成一份（reduce）"""
+    if len(text) <= SUMMARY_CHUNK_CHARS:
+        async with _llm_sem():
+            return await summarize_text_or_fallback(http, text)
+
+    async def _one(chunk: str) -> str:
+        async with _llm_sem():
+            return await summarize_text_or_fallback(http, chunk)
+
+    partials = await asyncio.gather(*map(_one, _chunk_text(text, SUMMARY_CHUNK_CHARS)))
+    if any(p.startswith(SUMMARY_FALLBACK_PREFIX) for p in partials):
+        # 分段已降级（无 key / 接口出错）：不再调合并，去掉各段重复的降级标头后拼成一份
+        lines = [
+            ln for p in partials for ln in p.splitlines()
+            if ln.strip() and not ln.startswith(SUMMARY_FALLBACK_PREFIX)
+        ]
+        return SUMMARY_FALLBACK_PREFIX + ("\n" + "\n".join(lines) if lines else " 無可摘要內容")
+    async with _llm_sem():
+        return await merge_summaries_or_fallback(http, partials)
+
+async def _summarize_text_for_chat(
+    http: httpx.AsyncClient, chat_id: str, start: datetime, end: datetime, full_text: str
+) -> None:
+    """对已取出的区间文字做摘要并发送（批量路径先一次查出所有群的文字再调这里）"""
     tip_start = start.date()
     tip_end = (end - timedelta(days=1)).date()
 
-    if not msgs:
+    if not full_text:
         await _send_reply(http, chat_id, f"（提示）{tip_start} ~ {tip_end} 无聊天记录，略过摘要。")
         return
 
-    # 整理文本
-    lines = [
-        m.get("text", "")
-        for m in msgs
-        if isinstance(m, dict) and (m.get("text") or "").strip()
-    ]
-    full_text = "\n".join(lines)
+    # 过长只保留最近的内容，限制模型耗时与费用
+    if len(full_text) > SUMMARY_MAX_CHARS:
+        logger.info("summary text truncated chat=%s chars=%s limit=%s", chat_id, len(full_text), SUMMARY_MAX_CHARS)
+        full_text = _tail_lines(full_text, SUMMARY_MAX_CHARS)
 
     # 取得原始摘要
     try:
-        raw_summary = await summarize_text_or_fallback(http, full_text)
+        raw_summary = await _summarize_chunked(http, full_text)
     except Exception:
         raw_summary = "(降级) 摘要服务暂不可用。"
 
@@ -367,45 +735,116 @@ async def _summarize_for_chat_in_range(
 
     # 产出统一格式
     header = f"【{tip_start} ~ {tip_end} 日讯息摘要】\n\n"
-    main_section = "・主要讨论事项：\n" + "\n".join(f"  {i+1}. {t}" for i, t in enumerate(topics))
-    reminder_section = "・重点提醒：\n" + "\n".join(f"  − {r}" for r in reminders)
+    main_section = "・主要讨论事项：\n" + "\n".join(map("  {0[0]}. {0[1]}".format, enumerate(topics, 1)))
+    reminder_section = "・重点提醒：\n" + "\n".join(map("  − {}".format, reminders))
     formatted = header + main_section + "\n\n" + reminder_section
 
     await _send_reply(http, chat_id, formatted)
 
 
-# ========== 全群区间摘要 ==========
-async def _summarize_for_all_chats_in_range(http: httpx.AsyncClient, start: datetime, end: datetime) -> int:
-    count = 0
+# ========== 启用群列表缓存 ==========
+_CHATS_CACHE: tuple[float, list] | None = None
+_CHATS_TTL = 60
+
+
+async def _get_enabled_chats_cached() -> list:
+    """(chat_id, tz) 列表缓存 60 秒，连续的全群摘要不重复查表"""
+    global _CHATS_CACHE
+    now = time.monotonic()
+    if _CHATS_CACHE and now - _CHATS_CACHE[0] < _CHATS_TTL:
+        return _CHATS_CACHE[1]
     async with AsyncSessionFactory() as db:
-        chats = await crud.get_all_chats(db)
-    for c in chats:
-        chat_id = c.get("chat_id")
-        tz = c.get("tz") or "Asia/Taipei"
-        if not chat_id:
-            continue
+        data = await crud.get_enabled_chat_tzs(db)
+    _CHATS_CACHE = (now, data)
+    return data
+
+
+def _invalidate_chats_cache() -> None:
+    global _CHATS_CACHE
+    _CHATS_CACHE = None
+
+
+# ========== 全群区间摘要 ==========
+async def _collect_tail_texts(db: AsyncSession, chat_ids: list[str], start: datetime, end: datetime) -> dict[str, str]:
+    # 边读边按群保留最近不超过 SUMMARY_MAX_CHARS 的整行，超出部分反正会被截掉，不必留在内存
+    tails: dict[str, deque[str]] = defaultdict(deque)
+    sizes: dict[str, int] = defaultdict(int)
+    async for cid, text in crud.iter_messages_by_chat_between(db, chat_ids, start, end):
+        dq = tails[cid]
+        dq.append(text)
+        sizes[cid] += len(text) + 1
+        while len(dq) > 1 and sizes[cid] - 1 > SUMMARY_MAX_CHARS:
+            sizes[cid] -= len(dq.popleft()) + 1
+    return {cid: "\n".join(dq) for cid, dq in tails.items()}
+
+
+async def _load_texts_by_chat(
+    chat_ids: list[str], start: datetime, end: datetime, db: AsyncSession | None = None
+) -> dict[str, str]:
+    """一条查询流式取回多个群的区间文字，按 chat_id 分组拼接"""
+    if db is None:
+        async with AsyncSessionFactory() as db:
+            return await _collect_tail_texts(db, chat_ids, start, end)
+    texts = await _collect_tail_texts(db, chat_ids, start, end)
+    await db.rollback()  # 读完即结束只读事务，摘要期间不占连接
+    return texts
+
+
+async def _bounded_summarize(
+    sem: asyncio.Semaphore, http: httpx.AsyncClient, chat_id: str, start: datetime, end: datetime, full_text: str
+) -> bool:
+    """限流下摘要单个群并记录耗时；异常在此吞掉，不让 TaskGroup 取消其他群"""
+    async with sem:
+        t0 = time.perf_counter()
         try:
-            await _summarize_for_chat_in_range(http, chat_id, start, end, tz=tz)
-            count += 1
-        except Exception:
-            pass
-    return count
+            await _summarize_text_for_chat(http, chat_id, start, end, full_text)
+        except Exception as e:
+            logger.warning("summary failed chat=%s elapsed=%.2fs err=%s", chat_id, time.perf_counter() - t0, e)
+            return False
+        logger.info("summary sent chat=%s chars=%s elapsed=%.2fs", chat_id, len(full_text), time.perf_counter() - t0)
+        return True
+
+
+async def _summarize_for_all_chats_in_range(
+    http: httpx.AsyncClient, start: datetime, end: datetime, db: AsyncSession | None = None
+) -> int:
+    chats = await _get_enabled_chats_cached()
+    sem = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+    chat_ids = [chat_id for chat_id, _tz in chats if chat_id]
+    texts = await _load_texts_by_chat(chat_ids, start, end, db=db)
+
+    # TaskGroup：外层被取消时会等所有子任务收尾，不留游离协程
+    async with asyncio.TaskGroup() as tg:
+        tasks_ = [
+            tg.create_task(_bounded_summarize(sem, http, chat_id, start, end, texts.get(chat_id, "")))
+            for chat_id in chat_ids
+        ]
+    return sum(1 for t in tasks_ if t.result())
 
 
 # ========== 每日入口（保留原行为） ==========
 async def summarize_for_all_chats(http: httpx.AsyncClient) -> None:
-    async with AsyncSessionFactory() as db:
-        chats = await crud.get_all_chats(db)
-    for c in chats:
-        chat_id = c.get("chat_id")
-        tz = c.get("tz") or "Asia/Taipei"
-        if not chat_id:
-            continue
+    chats = await _get_enabled_chats_cached()
+    sem = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+
+    # 按时区分组，每个时区只算一次昨日区间
+    by_tz: dict[str, list[str]] = defaultdict(list)
+    for chat_id, tz in chats:
+        if chat_id:
+            by_tz[tz or DEFAULT_TZ_NAME].append(chat_id)
+
+    # 先算好每个时区的区间并取回文字，再进 TaskGroup：某组准备失败只跳过该组，不会连带取消已排程的摘要
+    jobs: list[tuple[str, datetime, datetime, str]] = []
+    for tz, cids in by_tz.items():
         try:
-            start, end = _yesterday_range(tz)
-            await _summarize_for_chat_in_range(http, chat_id, start, end, tz=tz)
-        except Exception:
-            pass
-
-            
+            start, end = yesterday_range(_safe_zone(tz))
+            texts = await _load_texts_by_chat(cids, start, end)  # 每个时区一条查询
+        except Exception as e:
+            # 读库出错（如流式读取中途断线）只跳过这个时区的群，其余时区照常摘要
+            logger.warning("prepare summaries failed tz=%s chats=%s err=%s", tz, len(cids), e)
+            continue
+        jobs.extend((cid, start, end, texts.get(cid, "")) for cid in cids)
 
+    async with asyncio.TaskGroup() as tg:
+        for cid, start, end, text in jobs:
+            tg.create_task(_bounded_summarize(sem, http, cid, start, end, text))
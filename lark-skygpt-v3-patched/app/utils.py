@@ -1,4 +1,5 @@
 import io
+import os
 import logging
 import mimetypes
 from typing import Optional, Tuple, List
@@ -9,6 +10,8 @@ from .config import settings
 
 logger = logging.getLogger(__name__)
 TZ = ZoneInfo(settings.TIMEZONE)
+PDF_TEXT_BUDGET = int(os.getenv("PDF_TEXT_BUDGET", "40000"))  # PDF 抽字上限（字元），夠用即停
+EXCEL_TEXT_BUDGET = int(os.getenv("EXCEL_TEXT_BUDGET", "40000"))  # Excel 抽字上限（字元）
 
 # Optional deps
 try:
@@ -65,11 +68,16 @@ def extract_text_from_pdf(data: bytes) -> str:
     try:
         reader = PdfReader(io.BytesIO(data))
         parts = []
+        total = 0
         for page in reader.pages[:20]:
             try:
-                parts.append(page.extract_text() or "")
+                t = page.extract_text() or ""
             except Exception:
-                pass
+                continue
+            parts.append(t)
+            total += len(t)
+            if total >= PDF_TEXT_BUDGET:
+                break
         text = "\n".join(parts).strip()
         return text or "[PDF 無可抽取文字]"
     except Exception:
@@ -91,17 +99,28 @@ def extract_text_from_excel(data: bytes, max_sheets: int = 5, max_rows: int = 10
     try:
         wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
         out = []
+        total = 0
         for name in wb.sheetnames[:max_sheets]:
             sh = wb[name]
             out.append(f"--- 工作表: {name} ---")
             for r in sh.iter_rows(max_row=max_rows, max_col=max_cols, values_only=True):
-                row = ["" if v is None else str(v) for v in r]
-                if any(cell != "" for cell in row):
-                    out.append("\t".join(row))
+                # 空行先略過，不做逐格 str 轉換
+                if not any(v is not None and v != "" for v in r):
+                    continue
+                line = "\t".join("" if v is None else str(v) for v in r)
+                out.append(line)
+                total += len(line)
+                if total >= EXCEL_TEXT_BUDGET:
+                    break
+            if total >= EXCEL_TEXT_BUDGET:
+                break
         text = "\n".join(out).strip()
         if not text:
             return "[Excel 檔案無內容]"
-        if len(wb.sheetnames) > max_sheets or sh.max_row > max_rows or sh.max_column > max_cols:
+        # 依實際觸發的上限註明截斷原因：字元預算優先，其次才是表 / 行 / 欄上限
+        if total >= EXCEL_TEXT_BUDGET:
+            text += f"\n...（已截斷，達 {EXCEL_TEXT_BUDGET} 字元上限）"
+        elif len(wb.sheetnames) > max_sheets or sh.max_row > max_rows or sh.max_column > max_cols:
             text += f"\n...（可能已截斷，僅列前 {max_sheets} 張表、{max_rows} 行、{max_cols} 欄）"
         return text
     except Exception:
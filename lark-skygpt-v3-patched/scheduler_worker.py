@@ -1,13 +1,17 @@
 # app/scheduler_worker.py
 import os
+import time
+import random
+import signal
 import asyncio
 import logging
-from datetime import datetime
-from zoneinfo import ZoneInfo
+from collections import defaultdict
+from datetime import date, datetime
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 import httpx
+from apscheduler.jobstores.memory import MemoryJobStore
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
 
 from app.config import settings
 from app.database import init_db, AsyncSessionFactory
@@ -15,97 +19,197 @@ from app import crud, tasks
 
 logger = logging.getLogger("worker")
 logging.basicConfig(level=getattr(logging, (os.getenv("LOG_LEVEL") or "INFO").upper(), logging.INFO))
+_INFO = logger.isEnabledFor(logging.INFO)  # 執行期不會改日誌等級，匯入時判斷一次即可
 
 # 全局時區（兜底）
 DEFAULT_TZ = getattr(settings, "TIMEZONE", "Asia/Taipei") or "Asia/Taipei"
 SCAN_MINUTE = int(os.getenv("SCAN_MINUTE", "0"))  # 每小時第幾分掃描（預設 0：整點）
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "8"))  # 同時摘要的群數上限
+SCAN_LOCK_TTL_SEC = int(os.getenv("SCAN_LOCK_TTL_SEC", "600"))  # 掃描鎖過期時間（副本崩潰後自動釋放）
 
-def _now_hour_in_tz(tz_name: str | None) -> int:
-    tz = ZoneInfo(tz_name or DEFAULT_TZ)
-    return datetime.now(tz).hour
+def _summary_sem() -> asyncio.Semaphore:
+    """同時摘要的群數上限；按事件循環建立，run() 換循環時不會沿用舊循環的信號量"""
+    return tasks.loop_bound("worker_summary_sem", lambda: asyncio.Semaphore(SUMMARY_CONCURRENCY))
 
-def _today_str_in_tz(tz_name: str | None) -> str:
-    tz = ZoneInfo(tz_name or DEFAULT_TZ)
-    return str(datetime.now(tz).date())
+TZ = tasks.zone_info(DEFAULT_TZ)  # 排程器時區物件：匯入時解析一次（與 tasks 共用 ZoneInfo 快取）
+
+def _zone(tz_name: str | None) -> ZoneInfo:
+    """群設定的時區；名稱無效（如被小寫成 asia/tokyo）時記錄並退回 DEFAULT_TZ，不讓單一群拖垮整輪掃描。"""
+    try:
+        return tasks.zone_info(tz_name or DEFAULT_TZ)
+    except (ZoneInfoNotFoundError, ValueError) as e:
+        logger.warning("invalid chat tz %r, falling back to %s: %s", tz_name, DEFAULT_TZ, e)
+        return TZ
+
+def _now_by_tz(chats: list[dict]) -> dict[str, datetime]:
+    """每個不同時區只取一次當前時間，群迴圈內只做 dict 查找。"""
+    return {tz: datetime.now(_zone(tz)) for tz in {c.get("tz") or DEFAULT_TZ for c in chats}}
+
+def _is_permanent_db_error(e: BaseException) -> bool:
+    """認證失敗 / 資料庫不存在等重試也不會好的錯誤（SQLSTATE 28xxx、3D000）。"""
+    seen: set[int] = set()
+    err: BaseException | None = e
+    while err is not None and id(err) not in seen:
+        seen.add(id(err))
+        code = getattr(err, "sqlstate", None) or getattr(err, "pgcode", None)
+        if isinstance(code, str) and (code.startswith("28") or code == "3D000"):
+            return True
+        err = getattr(err, "orig", None) or err.__cause__
+    return False
 
 async def _startup_readiness(max_wait_sec: int = 60) -> None:
-    """確保 DB 建表完成再啟動排程，避免冷啟動時任務錯誤。"""
-    deadline = asyncio.get_event_loop().time() + max_wait_sec
+    """確保 DB 建表完成再啟動排程，避免冷啟動時任務錯誤（指數退避 + 抖動）。"""
+    deadline = time.monotonic() + max_wait_sec
+    delay = 0.25
     while True:
         try:
             await init_db()
             logger.info("DB ready.")
             return
         except Exception as e:
-            if asyncio.get_event_loop().time() > deadline:
+            if _is_permanent_db_error(e):
+                logger.error("DB readiness aborted (permanent error): %s", e)
+                return
+            if time.monotonic() > deadline:
                 logger.warning("DB readiness timeout: %s", e)
                 return
-            await asyncio.sleep(2)
+            await asyncio.sleep(delay + random.random() * 0.1)
+            delay = min(delay * 2, 5.0)
 
-async def _enabled_chats() -> list[dict]:
-    async with AsyncSessionFactory() as db:
-        return await crud.get_all_chats(db)  # 只取 enabled=True
+async def _enabled_chats(db) -> list[dict]:
+    return await crud.get_all_chats(db)  # 只取 enabled=True
 
-async def _summarize_chat_once_with_lock(http: httpx.AsyncClient, chat: dict, *, reason: str) -> None:
-    """對單一群做摘要（昨日），使用 SummaryLock 防止同日重複。"""
-    chat_id = chat.get("chat_id")
+async def _claim_chats(db, chats: list[dict], *, reason: str) -> list[dict]:
+    """按各群時區的「今天」分組，每組一條 INSERT 認領 SummaryLock，回傳本次認領成功的群。"""
+    by_day: dict[str, list[dict]] = defaultdict(list)
+    today_by_tz = {tz: str(now.date()) for tz, now in _now_by_tz(chats).items()}
+    for c in chats:
+        if c.get("chat_id"):
+            by_day[today_by_tz[c.get("tz") or DEFAULT_TZ]].append(c)
+    claimed: list[dict] = []
+    for today_str, group in by_day.items():
+        ids = [c["chat_id"] for c in group]
+        try:
+            got = await crud.acquire_summary_locks_bulk(db, today_str, ids)
+        except Exception as e:
+            await db.rollback()  # 共用會話：回滾後續組仍可用
+            logger.warning("lock acquire failed day=%s chats=%s err=%s", today_str, len(ids), e)
+            got = set(ids)  # 降級：不中斷
+        for c in group:
+            if c["chat_id"] in got:
+                claimed.append(c)
+            elif _INFO:
+                logger.info("skip chat=%s: already summarized today (%s), reason=%s", c["chat_id"], today_str, reason)
+    return claimed
+
+async def _summarize_chat(http: httpx.AsyncClient, chat: dict, rng: tuple[datetime, datetime], *, reason: str) -> None:
+    """對單一已認領的群做摘要（昨日，rng 由呼叫方按時區預先算好）。"""
+    chat_id = chat["chat_id"]
     tz = chat.get("tz") or DEFAULT_TZ
-    if not chat_id:
-        return
-    today_str = _today_str_in_tz(tz)
     try:
-        async with AsyncSessionFactory() as db:
-            got = await crud.acquire_summary_lock(db, today_str, chat_id)
-    except Exception as e:
-        logger.warning("lock acquire failed chat=%s err=%s", chat_id, e)
-        got = True  # 降級：不中斷
-    if not got:
-        logger.info("skip chat=%s: already summarized today (%s), reason=%s", chat_id, today_str, reason)
-        return
-    try:
-        logger.info("summarizing chat=%s tz=%s reason=%s", chat_id, tz, reason)
-        await tasks.summarize_for_single_chat(http, chat_id, tz=tz)
+        if _INFO:
+            logger.info("summarizing chat=%s tz=%s reason=%s", chat_id, tz, reason)
+        await tasks.summarize_for_single_chat(http, chat_id, tz=tz, start=rng[0], end=rng[1])
     except Exception as e:
         logger.exception("summarize failed chat=%s: %s", chat_id, e)
 
+async def _summarize_chats_once_with_lock(http: httpx.AsyncClient, db, chats: list[dict], *, reason: str) -> None:
+    """對多個群做摘要（昨日），先批次認領 SummaryLock 防止同日重複。"""
+    async def _one(c: dict) -> None:
+        async with _summary_sem():
+            await _summarize_chat(http, c, ranges[c.get("tz") or DEFAULT_TZ], reason=reason)
+
+    # 各群 I/O（DB / LLM / Lark）並發重疊，信號量限流避免打爆上游
+    claimed = await _claim_chats(db, chats, reason=reason)
+    # 昨日區間每個時區只算一次
+    ranges = {tz: tasks.yesterday_range(_zone(tz)) for tz in {c.get("tz") or DEFAULT_TZ for c in claimed}}
+    await asyncio.gather(*(_one(c) for c in claimed), return_exceptions=True)
+
 # --------------- 轨 1：每小時掃描，按群設定小時觸發 ---------------
 async def _run_hourly_scan():
-    chats = await _enabled_chats()
-    if not chats:
-        logger.info("__main__:hourly-scan: no active chats")
+    # 多副本部署時只讓一個副本做本輪掃描，其餘直接返回（群級 SummaryLock 仍兜底防重）
+    token = await tasks.try_acquire_lock("summary_scan:hourly", SCAN_LOCK_TTL_SEC)
+    if token is None:
+        logger.info("hourly-scan: another replica holds the scan lock, skip")
         return
-    async with httpx.AsyncClient(timeout=30) as http:
-        for c in chats:
-            tz = c.get("tz") or DEFAULT_TZ
-            hour = int(c.get("hour") or 8)
-            if _now_hour_in_tz(tz) != hour:
-                continue
-            await _summarize_chat_once_with_lock(http, c, reason="hourly_scan")
+    try:
+        await _hourly_scan()
+    finally:
+        await tasks.release_lock("summary_scan:hourly", token)
+
+async def _hourly_scan():
+    # 整輪掃描共用一個會話（讀群清單 + 認領鎖）；各群摘要並發執行，自行取會話
+    async with AsyncSessionFactory() as db:
+        tzs = await crud.get_enabled_chat_timezones(db)
+        if tzs:
+            # 先算各時區當前小時，再讓 SQL 只回傳本小時該觸發的群
+            hour_by_tz = {tz: datetime.now(_zone(tz)).hour for tz in tzs}
+            due = await crud.get_chats_scheduled_at(db, hour_by_tz)
+        else:
+            # 無啟用群：回退環境變數群清單（應急/灰度），客戶端篩選
+            chats = await _enabled_chats(db)
+            if not chats:
+                logger.info("__main__:hourly-scan: no active chats")
+                return
+            now_by_tz = _now_by_tz(chats)
+            due = [c for c in chats if now_by_tz[c.get("tz") or DEFAULT_TZ].hour == int(c.get("hour") or 8)]
+        if not due:
+            return
+        http = tasks.get_http_client()  # 與 tasks 共用同一個連線池
+        await _summarize_chats_once_with_lock(http, db, due, reason="hourly_scan")
 
 # --------------- 轨 2：每天 08:00 兜底（以 DEFAULT_TZ） ---------------
+_last_daily_run: date | None = None  # 本進程已跑過兜底的日期（同日重複觸發直接略過）
+
 async def _run_daily_fallback():
     """
     兜底：每天 DEFAULT_TZ 的 08:00 對所有啟用群再跑一輪。
     用與 hourly 相同的 Lock，避免重複。
     """
-    chats = await _enabled_chats()
-    if not chats:
-        logger.info("__main__:daily-fallback: no active chats")
+    global _last_daily_run
+    today = datetime.now(TZ).date()
+    if _last_daily_run == today:
+        logger.info("daily-fallback: already ran today (%s), skip", today)
         return
-    async with httpx.AsyncClient(timeout=30) as http:
-        for c in chats:
-            await _summarize_chat_once_with_lock(http, c, reason="daily_fallback")
+    _last_daily_run = today
 
-async def main():
-    logger.info("Worker starting… TZ=%s scan_minute=%s", DEFAULT_TZ, SCAN_MINUTE)
-    await _startup_readiness()
+    token = await tasks.try_acquire_lock("summary_scan:daily", SCAN_LOCK_TTL_SEC)
+    if token is None:
+        logger.info("daily-fallback: another replica holds the scan lock, skip")
+        return
+    try:
+        await _daily_fallback()
+    finally:
+        await tasks.release_lock("summary_scan:daily", token)
 
-    scheduler = AsyncIOScheduler(timezone=DEFAULT_TZ)
+async def _daily_fallback():
+    async with AsyncSessionFactory() as db:
+        chats = await _enabled_chats(db)
+        if not chats:
+            logger.info("__main__:daily-fallback: no active chats")
+            return
+        http = tasks.get_http_client()  # 與 tasks 共用同一個連線池
+        await _summarize_chats_once_with_lock(http, db, chats, reason="daily_fallback")
+
+def build_scheduler() -> AsyncIOScheduler:
+    """建立排程器並註冊兩條任務（未啟動）；獨立 worker 與 web 進程內模式共用。"""
+    # 觸發器以別名 "cron" 建立，由排程器統一帶入時區（直接 new CronTrigger() 不會繼承排程器時區，而是取主機本地時區）
+    scheduler = AsyncIOScheduler(
+        timezone=TZ,
+        jobstores={"default": MemoryJobStore()},  # 固定記憶體儲存：job 不需可 pickle
+        job_defaults={
+            "coalesce": True,  # 積壓多次只跑一次
+            "max_instances": 1,
+            "misfire_grace_time": None,  # 遲到多久都補跑（預設僅 1 秒，迴圈稍忙就會被丟棄）
+        },
+    )
 
     # 轨 1：每小時第 SCAN_MINUTE 分掃描（預設整點）
     scheduler.add_job(
         _run_hourly_scan,
-        CronTrigger(minute=SCAN_MINUTE, second=0),
+        "cron",
+        minute=SCAN_MINUTE,
+        second=0,
         id="hourly_chat_summary_scan",
         replace_existing=True,
     )
@@ -113,20 +217,81 @@ async def main():
     # 轨 2：兜底：每天 08:00（DEFAULT_TZ）再跑一輪
     scheduler.add_job(
         _run_daily_fallback,
-        CronTrigger(hour=8, minute=0, second=0),
+        "cron",
+        hour=8,
+        minute=0,
+        second=0,
         id="daily_fallback_all_chats",
         replace_existing=True,
     )
 
+    return scheduler
+
+async def start_scheduler() -> AsyncIOScheduler:
+    await _startup_readiness()
+    scheduler = build_scheduler()
     scheduler.start()
     logger.info("Scheduler started: hourly at *:%02d, and daily fallback at 08:00 (%s)", SCAN_MINUTE, DEFAULT_TZ)
+    return scheduler
+
+async def stop_scheduler(scheduler: AsyncIOScheduler) -> None:
+    scheduler.shutdown(wait=True)
+
+async def main():
+    logger.info("Worker starting… TZ=%s scan_minute=%s", DEFAULT_TZ, SCAN_MINUTE)
+    scheduler = await start_scheduler()
 
+    # 事件迴圈停在 Event 上等待，收到 SIGINT/SIGTERM 即刻收尾，不再每小時空轉喚醒
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    # 即使環境帶了 PYTHONASYNCIODEBUG / -X dev，也不對每個回呼計時
+    loop.set_debug(False)
+    loop.slow_callback_duration = 3600.0
+    installed: list[int] = []
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+            installed.append(sig)
+        except (NotImplementedError, RuntimeError):
+            pass  # 非主執行緒 / Windows 不支援，退回靠 CancelledError 結束
     try:
-        while True:
-            await asyncio.sleep(3600)
+        await stop.wait()
+        logger.info("Worker stopping…")
     except asyncio.CancelledError:
         pass
+    finally:
+        # 迴圈可能由呼叫方傳入並繼續使用：移除本次註冊的訊號處理，並釋放綁定在此迴圈上的連線
+        for sig in installed:
+            loop.remove_signal_handler(sig)
+        await stop_scheduler(scheduler)
+        await tasks.aclose_http()
+        await tasks.aclose_redis()
+
+def run(loop: asyncio.AbstractEventLoop | None = None) -> None:
+    """跑 worker；可傳入既有事件迴圈（測試共用），未傳入則自建並在結束時關閉。"""
+    own = loop is None
+    if own:
+        loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        if own:
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.run_until_complete(loop.shutdown_default_executor())
+            loop.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # 只在獨立 worker 進程生效（測試或 web 進程呼叫 run() 時不改動全域 logging 設定）：
+    # 格式裡不用 process/thread 欄位，關掉後每筆紀錄省去 getpid / current_thread 呼叫
+    logging.logProcesses = False
+    logging.logThreads = False
+    logging.logMultiprocessing = False
+    logging.raiseExceptions = False
+    # 有 uvloop 就用（libuv 實作，事件分派更省 CPU），否則用預設迴圈
+    try:
+        import uvloop  # type: ignore
+        uvloop.install()
+    except ImportError:
+        pass
+    run()
 
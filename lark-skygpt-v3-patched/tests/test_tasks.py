@@ -0,0 +1,61 @@
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault("APP_ID", "test")
+os.environ.setdefault("APP_SECRET", "test")
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///:memory:")
+os.environ.setdefault("REDIS_URL", "")
+
+from app import tasks  # noqa: E402
+
+
+class SummarizeForAllChatsTest(unittest.IsolatedAsyncioTestCase):
+    async def test_load_failure_only_skips_that_tz_group(self):
+        chats = [("a", "Asia/Taipei"), ("b", "Asia/Tokyo"), ("c", "Asia/Taipei")]
+        tokyo = tasks.zone_info("Asia/Tokyo")
+
+        async def load(chat_ids, start, end, db=None):
+            if start.tzinfo is tokyo:
+                raise ConnectionError("connection dropped mid-stream")
+            return {cid: f"text {cid}" for cid in chat_ids}
+
+        sent = []
+
+        async def summarize(http, chat_id, start, end, full_text):
+            sent.append((chat_id, full_text))
+
+        with mock.patch.object(tasks, "_get_enabled_chats_cached", mock.AsyncMock(return_value=chats)), \
+                mock.patch.object(tasks, "_load_texts_by_chat", load), \
+                mock.patch.object(tasks, "_summarize_text_for_chat", summarize):
+            await tasks.summarize_for_all_chats(http=None)
+
+        self.assertEqual(sorted(sent), [("a", "text a"), ("c", "text c")])
+
+
+class CommandDispatchTest(unittest.IsolatedAsyncioTestCase):
+    async def dispatch(self, text):
+        on, off = mock.AsyncMock(), mock.AsyncMock()
+        handlers = {("#summary", "on"): on, ("#summary", "off"): off}
+        event = {"event": {"message": {"chat_id": "oc_1", "content": "", "sender": {}}}}
+        with mock.patch.dict(tasks._HANDLERS, handlers), \
+                mock.patch.object(tasks, "_ensure_chat", mock.AsyncMock()), \
+                mock.patch.object(tasks, "get_http_client", mock.Mock()):
+            await tasks.maybe_handle_summary_command(event, parsed_content={"text": text})
+        return on, off
+
+    async def test_trailing_punctuation_on_keyword(self):
+        for text in ("#summary on", "#summary on。", "#summary On!", "#summary on ！"):
+            on, off = await self.dispatch(text)
+            self.assertEqual((on.await_count, off.await_count), (1, 0), text)
+        for text in ("#summary off!", "#summary off。", "#summary off？"):
+            on, off = await self.dispatch(text)
+            self.assertEqual((on.await_count, off.await_count), (0, 1), text)
+
+    async def test_unknown_keyword_is_ignored(self):
+        on, off = await self.dispatch("#summary onward")
+        self.assertEqual((on.await_count, off.await_count), (0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()